@@ -5,10 +5,14 @@ Svety Bot — логичный мастер создания открыток.
 
 Зависимости (pip):
   python-telegram-bot==20.*
+  aiofiles
   pillow
+  numpy
+  orjson
   qrcode
   python-dotenv
 Рекомендуется установить шрифт: fonts-dejavu-core (для DejaVuSans.ttf)
+и libqrencode4 (быстрая генерация QR; без неё используем qrcode)
 
 ENV (.env):
   TELEGRAM_BOT_TOKEN=7737841966:AAFIgmwHXNw1mvYZ8a4Jysl9KH1b_hb1x-c
@@ -31,20 +35,31 @@ ENV (.env):
 from __future__ import annotations
 
 import asyncio
+import ctypes
+import ctypes.util
+import functools
+import hashlib
 import io
-import json
 import logging
+import multiprocessing
 import os
 import re
+import sys
 import textwrap
 import time
 import uuid
-from dataclasses import dataclass, field
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, fields
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Tuple, Any
+from typing import Dict, Iterable, Tuple, Any
 
+import aiofiles
+import aiofiles.os
 from dotenv import load_dotenv
+import numpy as np
+import orjson
 from PIL import Image, ImageDraw, ImageFont
 import qrcode
 
@@ -53,6 +68,7 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InputFile,
+    InputMediaPhoto,
 )
 from telegram.constants import ParseMode
 from telegram.ext import (
@@ -90,10 +106,12 @@ DATA_DIR.mkdir(parents=True, exist_ok=True)
 # -------------
 MENU, CHOOSE_TPL, SET_BG, SET_TITLE, SET_SUBTITLE, SET_BODY, SET_STYLE, SET_QR, PREVIEW, PROJECTS = range(10)
 
+DEFAULT_FONT = "DejaVuSans.ttf"
+
 # --------------------
 # Утилиты и модели
 # --------------------
-@dataclass
+@dataclass(slots=True)
 class Project:
     id: str
     user_id: int
@@ -104,7 +122,7 @@ class Project:
     title: str = ""
     subtitle: str = ""
     body: str = ""
-    font_name: str = "DejaVuSans.ttf"
+    font_name: str = DEFAULT_FONT
     font_color: str = "#111111"
     align: str = "center"      # left|center|right
     qr_enabled: bool = False
@@ -118,13 +136,16 @@ class Project:
         return DATA_DIR / str(self.user_id) / self.id
 
     def to_dict(self) -> Dict[str, Any]:
-        return self.__dict__
+        return {name: getattr(self, name) for name in _PROJECT_FIELDS}
 
     @classmethod
     def from_dict(cls, d: Dict[str, Any]) -> "Project":
         return cls(**d)
 
 
+_PROJECT_FIELDS = tuple(f.name for f in fields(Project))
+
+
 def new_project(user_id: int) -> Project:
     pid = uuid.uuid4().hex[:10]
     p = Project(id=pid, user_id=user_id)
@@ -133,35 +154,136 @@ def new_project(user_id: int) -> Project:
     return p
 
 
-def save_project(p: Project) -> None:
+SAVE_DEBOUNCE_S = 0.5
+_pending: Dict[str, Project] = {}
+_timers: Dict[str, asyncio.TimerHandle] = {}
+# pid -> [lock, сколько записей его ждёт/держит]; запись уходит с последней
+_write_locks: Dict[str, list] = {}
+_writes: set[asyncio.Task] = set()
+
+
+async def _write_project(p: Project) -> None:
+    # tmp + rename: meta.json никогда не остаётся недописанным
+    data = orjson.dumps(p.to_dict())
+    entry = _write_locks.setdefault(p.id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            await aiofiles.os.makedirs(p.root, exist_ok=True)
+            tmp = p.root / "meta.json.tmp"
+            async with aiofiles.open(tmp, "wb") as f:
+                await f.write(data)
+            await aiofiles.os.replace(tmp, p.root / "meta.json")
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _write_locks[p.id]
+    # mtime каталога пользователя от правки meta.json внутри проекта не меняется;
+    # счётчик отбрасывает скан, который шёл параллельно с этой записью
+    _projects_gen[p.user_id] = _projects_gen.get(p.user_id, 0) + 1
+    _projects_cache.pop(p.user_id, None)
+
+
+async def _flush_task(p: Project) -> None:
+    try:
+        await _write_project(p)
+    except Exception:
+        log.exception("Не удалось сохранить проект %s", p.id)
+    finally:
+        # пока запись шла, мог прийти новый save_project — тогда ждём его
+        if p.id not in _timers:
+            _pending.pop(p.id, None)
+
+
+def _flush(pid: str) -> None:
+    _timers.pop(pid, None)
+    p = _pending.get(pid)
+    if p is None:
+        return
+    task = asyncio.get_running_loop().create_task(_flush_task(p))
+    _writes.add(task)
+    task.add_done_callback(_writes.discard)
+
+
+async def save_project(p: Project) -> None:
+    """Отложенная запись: серия тапов по кнопкам схлопывается в одну запись."""
     p.updated_at = time.time()
-    p.root.mkdir(parents=True, exist_ok=True)
-    meta = p.root / "meta.json"
-    meta.write_text(json.dumps(p.to_dict(), ensure_ascii=False, indent=2), encoding="utf-8")
+    _pending[p.id] = p
+    timer = _timers.pop(p.id, None)
+    if timer is not None:
+        timer.cancel()
+    _timers[p.id] = asyncio.get_running_loop().call_later(SAVE_DEBOUNCE_S, _flush, p.id)
 
 
-def load_project(user_id: int, pid: str) -> Project | None:
-    meta = DATA_DIR / str(user_id) / pid / "meta.json"
-    if not meta.exists():
-        return None
-    d = json.loads(meta.read_text(encoding="utf-8"))
-    return Project.from_dict(d)
+async def save_project_now(p: Project) -> None:
+    """Немедленная запись — там, где важна сохранность (кнопка «Сохранить»)."""
+    p.updated_at = time.time()
+    timer = _timers.pop(p.id, None)
+    if timer is not None:
+        timer.cancel()
+    _pending[p.id] = p
+    await _flush_task(p)
+
+
+async def flush_projects(live: Iterable[Project] = ()) -> None:
+    """
+    Дописать всё на диск при остановке. live — проекты из user_data:
+    тапы по кнопкам меняют их без save_project, в _pending их может не быть.
+    """
+    for pid in list(_timers):
+        _timers.pop(pid).cancel()
+    for p in live:
+        _pending.setdefault(p.id, p)
+    await asyncio.gather(
+        *_writes,
+        *(_flush_task(p) for p in list(_pending.values())),
+    )
+
+
+_projects_cache: Dict[int, Tuple[float, int, list[Project]]] = {}
+_projects_gen: Dict[int, int] = {}  # user_id -> число записей meta.json
 
 
-def list_projects(user_id: int, limit: int = 8) -> list[Project]:
-    base = DATA_DIR / str(user_id)
-    if not base.exists():
-        return []
+def _scan_projects(base: Path, cached_mtime: float | None) -> Tuple[float | None, list[Path] | None]:
+    # stat/сортировка одним заходом в executor, а не по syscall-у на event loop;
+    # каталог пользователя не менялся — детей не трогаем вовсе
+    try:
+        base_mtime = base.stat().st_mtime
+    except FileNotFoundError:
+        return None, []
+    if base_mtime == cached_mtime:
+        return base_mtime, None
+    children = sorted(base.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True)
+    return base_mtime, [child / "meta.json" for child in children if (child / "meta.json").exists()]
+
+
+async def list_projects(user_id: int, limit: int = 8) -> list[Project]:
+    cached = _projects_cache.get(user_id)
+    if cached is not None and cached[1] != limit:
+        cached = None
+    gen = _projects_gen.get(user_id, 0)
+    loop = asyncio.get_running_loop()
+    base_mtime, metas = await loop.run_in_executor(
+        None, _scan_projects, DATA_DIR / str(user_id), cached[0] if cached else None
+    )
+    if metas is None:
+        if _projects_gen.get(user_id, 0) == gen:
+            return cached[2]
+        # кэш устарел прямо во время stat — сканируем заново
+        base_mtime, metas = await loop.run_in_executor(None, _scan_projects, DATA_DIR / str(user_id), None)
     items = []
-    for child in sorted(base.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True):
-        if (child / "meta.json").exists():
-            try:
-                d = json.loads((child / "meta.json").read_text(encoding="utf-8"))
-                items.append(Project.from_dict(d))
-            except Exception:
-                continue
+    for meta in metas:
+        try:
+            async with aiofiles.open(meta, "rb") as f:
+                d = orjson.loads(await f.read())
+            items.append(Project.from_dict(d))
+        except Exception:
+            continue
         if len(items) >= limit:
             break
+    # пока сканировали, проект мог записаться — такой список в кэш не кладём
+    if base_mtime is not None and _projects_gen.get(user_id, 0) == gen:
+        _projects_cache[user_id] = (base_mtime, limit, items)
     return items
 
 
@@ -170,8 +292,10 @@ def list_projects(user_id: int, limit: int = 8) -> list[Project]:
 # ----------------------------
 CANVAS = (1200, 1500)  # 4:5 вертикаль, удобно для превью
 MARGIN = 80
+FONT_SIZES = (90, 56, 44)  # заголовок, подзаголовок, текст
 
 
+@functools.lru_cache(maxsize=256)
 def hex_to_rgb(hex_color: str) -> Tuple[int, int, int]:
     hex_color = hex_color.strip().lstrip('#')
     if len(hex_color) == 3:
@@ -184,14 +308,17 @@ def hex_to_rgb(hex_color: str) -> Tuple[int, int, int]:
     return (r, g, b)
 
 
+FONT_FALLBACKS = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/freefont/FreeSans.ttf",
+)
+
+
+@functools.lru_cache(maxsize=64)
 def get_font(font_name: str, size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
-    # Ищем шрифт в системе; если нет — падать нельзя
-    candidates = [
-        font_name,
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-        "/usr/share/fonts/truetype/freefont/FreeSans.ttf",
-    ]
-    for p in candidates:
+    # Ищем шрифт в системе; если нет — падать нельзя.
+    # Один FreeType face на (шрифт, размер) на всё время жизни процесса.
+    for p in (font_name, *FONT_FALLBACKS):
         try:
             return ImageFont.truetype(p, size)
         except Exception:
@@ -199,60 +326,169 @@ def get_font(font_name: str, size: int) -> ImageFont.FreeTypeFont | ImageFont.Im
     return ImageFont.load_default()
 
 
+# --------------------------
+# QR: libqrencode через ctypes
+# --------------------------
+class _QRcode(ctypes.Structure):
+    _fields_ = [
+        ("version", ctypes.c_int),
+        ("width", ctypes.c_int),
+        ("data", ctypes.POINTER(ctypes.c_ubyte)),
+    ]
+
+
+QR_ECLEVEL_L = 0
+QR_MODE_8 = 2
+
+
+def _load_libqrencode() -> ctypes.CDLL | None:
+    name = ctypes.util.find_library("qrencode")
+    if not name:
+        return None
+    try:
+        lib = ctypes.CDLL(name)
+    except OSError:
+        return None
+    lib.QRcode_encodeString.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    lib.QRcode_encodeString.restype = ctypes.POINTER(_QRcode)
+    lib.QRcode_free.argtypes = [ctypes.POINTER(_QRcode)]
+    lib.QRcode_free.restype = None
+    return lib
+
+
+_libqrencode = _load_libqrencode()
+if _libqrencode is None:
+    log.info("libqrencode не найдена, QR строим через пакет qrcode")
+
+
+@functools.lru_cache(maxsize=256)
+def build_qr_matrix(url: str) -> np.ndarray:
+    """Матрица модулей QR (True — тёмный модуль) с рамкой в 1 модуль."""
+    if _libqrencode is not None:
+        code = _libqrencode.QRcode_encodeString(url.encode("utf-8"), 0, QR_ECLEVEL_L, QR_MODE_8, 1)
+        if code:
+            try:
+                width = code.contents.width
+                buf = ctypes.string_at(code.contents.data, width * width)
+            finally:
+                _libqrencode.QRcode_free(code)
+            # младший бит байта — цвет модуля
+            matrix = (np.frombuffer(buf, dtype=np.uint8) & 1).astype(bool).reshape(width, width)
+            return np.pad(matrix, 1, constant_values=False)
+        log.warning("libqrencode не смогла закодировать URL, пробуем qrcode")
+    qr = qrcode.QRCode(border=1, error_correction=qrcode.constants.ERROR_CORRECT_L)
+    qr.add_data(url)
+    qr.make(fit=True)
+    return np.array(qr.get_matrix(), dtype=bool)
+
+
+@functools.lru_cache(maxsize=64)
+def line_height(font: ImageFont.FreeTypeFont | ImageFont.ImageFont) -> int:
+    # высота строки одна на шрифт, не меряем каждую строку заново
+    try:
+        ascent, descent = font.getmetrics()
+        return ascent + descent
+    except AttributeError:  # bitmap-шрифт load_default()
+        bbox = font.getbbox("Ay")
+        return bbox[3] - bbox[1]
+
+
+@functools.lru_cache(maxsize=128)
+def _qr_image(url: str, size: int) -> Image.Image:
+    # готовая картинка на (url, размер); только читаем её через paste, не меняем
+    matrix = build_qr_matrix(url)
+    qr_img = Image.fromarray((~matrix).astype(np.uint8) * 255)
+    # модули бинарные — NEAREST, а не LANCZOS
+    return qr_img.resize((size, size), Image.NEAREST).convert("RGB")
+
+
 def draw_wrapped(draw: ImageDraw.ImageDraw, text: str, area: Tuple[int, int, int, int], font: ImageFont.ImageFont, fill: Tuple[int, int, int], align: str) -> None:
     if not text:
         return
     x0, y0, x1, y1 = area
     max_w = x1 - x0
-    # примитивный перенос строк
     words = text.split()
-    lines, line = [], []
-    for w in words:
-        t = " ".join(line + [w])
-        wpx, _ = draw.textsize(t, font=font)
-        if wpx <= max_w:
-            line.append(w)
+    if not words:
+        return
+    # ширину каждого слова меряем один раз, строки набираем по сумме
+    space_w = font.getlength(" ")
+    word_w = [font.getlength(w) for w in words]
+    total_w = sum(word_w) + space_w * (len(words) - 1)
+    if total_w <= max_w:
+        lines = [(" ".join(words), total_w)]
+    else:
+        lines = []
+        start, cur_w = 0, word_w[0]
+        for i in range(1, len(words)):
+            if cur_w + space_w + word_w[i] <= max_w:
+                cur_w += space_w + word_w[i]
+            else:
+                lines.append((" ".join(words[start:i]), cur_w))
+                start, cur_w = i, word_w[i]
+        lines.append((" ".join(words[start:]), cur_w))
+
+    hpx = line_height(font)
+    step = int(hpx * 1.25)
+    # всё влезает по высоте — рисуем одним вызовом, без обрезки по строкам
+    if isinstance(font, ImageFont.FreeTypeFont) and y0 + step * (len(lines) - 1) + hpx <= y1:
+        if align == "left":
+            xy, anchor = (x0, y0), "la"
+        elif align == "right":
+            xy, anchor = (x1, y0), "ra"
         else:
-            if line:
-                lines.append(" ".join(line))
-            line = [w]
-    if line:
-        lines.append(" ".join(line))
+            xy, anchor = (x0 + max_w // 2, y0), "ma"
+        # Pillow ставит строки с шагом bbox("A").bottom + spacing — подгоняем под step
+        spacing = step - font.getbbox("A")[3]
+        draw.multiline_text(xy, "\n".join(ln for ln, _ in lines), font=font, fill=fill,
+                            anchor=anchor, align=align, spacing=spacing)
+        return
 
     y = y0
-    for ln in lines:
-        wpx, hpx = draw.textsize(ln, font=font)
+    for ln, wpx in lines:
         if align == "left":
             x = x0
         elif align == "right":
-            x = x1 - wpx
+            x = x1 - int(wpx)
         else:
-            x = x0 + (max_w - wpx) // 2
+            x = x0 + (max_w - int(wpx)) // 2
         if y + hpx > y1:
             break
         draw.text((x, y), ln, font=font, fill=fill)
-        y += int(hpx * 1.25)
+        y += step
+
 
+def fit_background(src: io.BytesIO, out: Path) -> None:
+    """Привести загруженный фон к размеру полотна — один раз, при загрузке."""
+    with Image.open(src) as im:
+        # draft даёт JPEG-декодеру уменьшить фото ещё при распаковке, но не меньше
+        # полотна по каждой оси — дальше один LANCZOS без апскейла
+        im.draft("RGB", CANVAS)
+        bg = im.convert("RGB")
+    if bg.size != CANVAS:
+        bg = bg.resize(CANVAS, Image.LANCZOS)
+    bg.save(out, "JPEG", quality=88, optimize=True)
 
-def render_image(p: Project, *, final: bool = False) -> Path:
-    """Собрать превью/финал и вернуть путь к файлу."""
+
+def render_image(p: Project, final: bool = False) -> bytes:
+    """Собрать превью/финал: файл на диске и те же JPEG-байты для отправки."""
     W, H = CANVAS
-    img = Image.new("RGB", CANVAS, color=hex_to_rgb(p.bg_color))
-    draw = ImageDraw.Draw(img)
+    img = None
 
-    # Фон-картинка
+    # Фон-картинка: она и есть полотно, заливать цветом под ней незачем
     if p.bg_mode == "image" and p.bg_image and Path(p.bg_image).exists():
         try:
-            bg = Image.open(p.bg_image).convert("RGB")
-            bg = bg.resize(CANVAS, Image.LANCZOS)
-            img.paste(bg, (0, 0))
+            img = Image.open(p.bg_image).convert("RGB")
+            if img.size != CANVAS:  # фоны, загруженные до подгонки при загрузке
+                img = img.resize(CANVAS, Image.LANCZOS)
         except Exception as e:
+            img = None
             log.warning("Не удалось применить фоновое изображение: %s", e)
+    if img is None:
+        img = Image.new("RGB", CANVAS, color=hex_to_rgb(p.bg_color))
+    draw = ImageDraw.Draw(img)
 
     # Заголовок / подзаголовок / текст
-    title_font = get_font(p.font_name, 90)
-    subtitle_font = get_font(p.font_name, 56)
-    body_font = get_font(p.font_name, 44)
+    title_font, subtitle_font, body_font = (get_font(p.font_name, size) for size in FONT_SIZES)
     color = hex_to_rgb(p.font_color)
 
     # Верхний блок — заголовок и подзаголовок
@@ -268,12 +504,7 @@ def render_image(p: Project, *, final: bool = False) -> Path:
 
     # QR
     if p.qr_enabled and p.qr_url:
-        qr = qrcode.QRCode(border=1, box_size=10)
-        qr.add_data(p.qr_url)
-        qr.make(fit=True)
-        qr_img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-        # масштабируем к желаемому размеру
-        qr_img = qr_img.resize((p.qr_size, p.qr_size), Image.LANCZOS)
+        qr_img = _qr_image(p.qr_url, p.qr_size)
         positions = {
             "tl": (MARGIN, MARGIN),
             "tr": (W - MARGIN - p.qr_size, MARGIN),
@@ -283,58 +514,59 @@ def render_image(p: Project, *, final: bool = False) -> Path:
         }
         img.paste(qr_img, positions.get(p.qr_pos, positions["br"]))
 
-    # Сохранение
+    # Сохранение (meta.json могла ещё не записаться — каталога может не быть)
+    p.root.mkdir(parents=True, exist_ok=True)
     out = p.root / ("final.jpg" if final else "preview.jpg")
-    img.save(out, quality=90)
-    return out
+    # превью — быстрее и легче, финал — с оптимизацией таблиц Хаффмана
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=(92 if final else 80), subsampling=2, optimize=final, progressive=False)
+    data = buf.getvalue()
+    out.write_bytes(data)
+    return data
 
 
 # -------------------------------------
 # UI: клавиатуры и парсер callback_data
 # -------------------------------------
 
-def kb_menu() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🪄 Создать открытку", callback_data="a:new")],
-        [InlineKeyboardButton("📁 Мои проекты", callback_data="a:list")],
-        [InlineKeyboardButton("⚙️ Настройки", callback_data="a:settings")],
-    ])
+# Клавиатуры неизменяемые — собираем один раз при импорте
+KB_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🪄 Создать открытку", callback_data="a:new")],
+    [InlineKeyboardButton("📁 Мои проекты", callback_data="a:list")],
+    [InlineKeyboardButton("⚙️ Настройки", callback_data="a:settings")],
+])
 
 
-def kb_templates() -> InlineKeyboardMarkup:
-    rows = [
-        [InlineKeyboardButton("Classic", callback_data="a:tpl|id=classic"),
-         InlineKeyboardButton("Minimal", callback_data="a:tpl|id=minimal")],
-        [InlineKeyboardButton("Elegant", callback_data="a:tpl|id=elegant")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="a:back|to=menu"), InlineKeyboardButton("Далее ➡️", callback_data="a:to|s=SET_BG")]
-    ]
-    return InlineKeyboardMarkup(rows)
+KB_TEMPLATES = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Classic", callback_data="a:tpl|id=classic"),
+     InlineKeyboardButton("Minimal", callback_data="a:tpl|id=minimal")],
+    [InlineKeyboardButton("Elegant", callback_data="a:tpl|id=elegant")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="a:back|to=menu"), InlineKeyboardButton("Далее ➡️", callback_data="a:to|s=SET_BG")]
+])
 
 
-def kb_bg() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Фон: цвет", callback_data="a:bg|mode=color"),
-         InlineKeyboardButton("Фон: фото", callback_data="a:bg|mode=image")],
-        [InlineKeyboardButton("Цвет: белый", callback_data="a:bgcolor|c=#ffffff"),
-         InlineKeyboardButton("Цвет: бежевый", callback_data="a:bgcolor|c=#fff7e6")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="a:back|to=tpl"),
-         InlineKeyboardButton("Далее ➡️", callback_data="a:to|s=SET_TITLE")],
-    ])
+KB_BG = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Фон: цвет", callback_data="a:bg|mode=color"),
+     InlineKeyboardButton("Фон: фото", callback_data="a:bg|mode=image")],
+    [InlineKeyboardButton("Цвет: белый", callback_data="a:bgcolor|c=#ffffff"),
+     InlineKeyboardButton("Цвет: бежевый", callback_data="a:bgcolor|c=#fff7e6")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="a:back|to=tpl"),
+     InlineKeyboardButton("Далее ➡️", callback_data="a:to|s=SET_TITLE")],
+])
 
 
-def kb_align_style() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Выровнять: влево", callback_data="a:align|v=left"),
-         InlineKeyboardButton("по центру", callback_data="a:align|v=center"),
-         InlineKeyboardButton("вправо", callback_data="a:align|v=right")],
-        [InlineKeyboardButton("Цвет текста: тёмный", callback_data="a:fcolor|c=#111111"),
-         InlineKeyboardButton("светлый", callback_data="a:fcolor|c=#ffffff")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="a:back|to=text"),
-         InlineKeyboardButton("Далее ➡️", callback_data="a:to|s=SET_QR")],
-    ])
+KB_ALIGN_STYLE = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Выровнять: влево", callback_data="a:align|v=left"),
+     InlineKeyboardButton("по центру", callback_data="a:align|v=center"),
+     InlineKeyboardButton("вправо", callback_data="a:align|v=right")],
+    [InlineKeyboardButton("Цвет текста: тёмный", callback_data="a:fcolor|c=#111111"),
+     InlineKeyboardButton("светлый", callback_data="a:fcolor|c=#ffffff")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="a:back|to=text"),
+     InlineKeyboardButton("Далее ➡️", callback_data="a:to|s=SET_QR")],
+])
 
 
-def kb_qr(on: bool) -> InlineKeyboardMarkup:
+def _build_kb_qr(on: bool) -> InlineKeyboardMarkup:
     row1 = [InlineKeyboardButton("QR: Вкл" if not on else "QR: Выкл",
                                  callback_data=f"a:qr|enable={'1' if not on else '0'}")]
     row2 = [InlineKeyboardButton("Позиция ↖", callback_data="a:qrpos|p=tl"),
@@ -349,6 +581,15 @@ def kb_qr(on: bool) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([row1, row2, row3, row4])
 
 
+KB_QR_ON = _build_kb_qr(True)
+KB_QR_OFF = _build_kb_qr(False)
+
+
+def kb_qr(on: bool) -> InlineKeyboardMarkup:
+    return KB_QR_ON if on else KB_QR_OFF
+
+
+@functools.lru_cache(maxsize=1024)
 def kb_preview(pid: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✏️ Текст", callback_data="a:to|s=SET_TITLE"),
@@ -360,20 +601,15 @@ def kb_preview(pid: str) -> InlineKeyboardMarkup:
     ])
 
 
+_CB_RE = re.compile(r"([^|=]+)=([^|]*)")
+
+
 def parse_cb(data: str) -> Tuple[str, Dict[str, str]]:
     # формат: a:<action>|k=v|k2=v2
     if not data.startswith("a:"):
         return data, {}
-    data = data[2:]
-    if "|" in data:
-        action, rest = data.split("|", 1)
-        kv = {}
-        for part in rest.split("|"):
-            if "=" in part:
-                k, v = part.split("=", 1)
-                kv[k] = v
-        return action, kv
-    return data, {}
+    action, _, rest = data[2:].partition("|")
+    return sys.intern(action), dict(_CB_RE.findall(rest))
 
 
 # ---------------------
@@ -381,16 +617,22 @@ def parse_cb(data: str) -> Tuple[str, Dict[str, str]]:
 # ---------------------
 
 def get_current_project(context: ContextTypes.DEFAULT_TYPE) -> Project | None:
-    pid = context.user_data.get("pid")
-    uid = context._user_id  # type: ignore[attr-defined]
-    if not pid:
-        return None
-    return load_project(uid, pid)
+    # живой проект держим в user_data; на диск он уходит на превью/сохранении
+    return context.user_data.get("project")
 
 
-def set_current_project(context: ContextTypes.DEFAULT_TYPE, p: Project) -> None:
+async def set_current_project(context: ContextTypes.DEFAULT_TYPE, p: Project) -> None:
     context.user_data["pid"] = p.id
-    save_project(p)
+    context.user_data["project"] = p
+    await save_project(p)
+
+
+async def edit_markup(q, markup: InlineKeyboardMarkup) -> None:
+    # клавиатура не поменялась (цвет, выравнивание, позиция QR) — API не дёргаем:
+    # лишний запрос к лимиту, а Telegram ещё и ответит «message is not modified»
+    if q.message is not None and q.message.reply_markup == markup:
+        return
+    await q.edit_message_reply_markup(reply_markup=markup)
 
 
 # ------------------
@@ -400,17 +642,20 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.effective_message.reply_text(
         "Привет! Я помогу собрать красивую цифровую открытку ✨\n"
         "Нажми кнопку ниже, чтобы начать.",
-        reply_markup=kb_menu(),
+        reply_markup=KB_MENU,
     )
     return MENU
 
 
 async def cmd_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.effective_message.reply_text("Главное меню:", reply_markup=kb_menu())
+    await update.effective_message.reply_text("Главное меню:", reply_markup=KB_MENU)
     return MENU
 
 
 async def cmd_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    p = get_current_project(context)
+    if p:
+        await save_project_now(p)
     await update.effective_message.reply_text("Ок, отменил. Возвращайся, когда будешь готов 🙌")
     return ConversationHandler.END
 
@@ -426,16 +671,16 @@ async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     if action == "new":
         p = new_project(uid)
-        set_current_project(context, p)
+        await set_current_project(context, p)
         await q.edit_message_text(
-            "Выбери шаблон:", reply_markup=kb_templates()
+            "Выбери шаблон:", reply_markup=KB_TEMPLATES
         )
         return CHOOSE_TPL
 
     if action == "list":
-        items = list_projects(uid)
+        items = await list_projects(uid)
         if not items:
-            await q.edit_message_text("У тебя пока нет проектов. Нажми \"Создать открытку\".", reply_markup=kb_menu())
+            await q.edit_message_text("У тебя пока нет проектов. Нажми \"Создать открытку\".", reply_markup=KB_MENU)
             return MENU
         # Покажем списком названий и дат
         text = ["Твои последние проекты:"]
@@ -443,115 +688,107 @@ async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             dt = datetime.fromtimestamp(it.updated_at).strftime("%Y-%m-%d %H:%M")
             text.append(f"• {it.id} — {dt}")
         text.append("\nНажми \"Создать открытку\" чтобы начать новый.")
-        await q.edit_message_text("\n".join(text), reply_markup=kb_menu())
+        await q.edit_message_text("\n".join(text), reply_markup=KB_MENU)
         return MENU
 
     if action == "tpl":
         p = get_current_project(context)
         if not p:
-            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
             return MENU
         p.template = kv.get("id", p.template)
-        save_project(p)
         await q.edit_message_text(
             "Фон. Можешь выбрать цвет или прислать фото (как изображение, не как файл).",
-            reply_markup=kb_bg(),
+            reply_markup=KB_BG,
         )
         return SET_BG
 
     if action == "bg":
         p = get_current_project(context)
         if not p:
-            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
             return MENU
         mode = kv.get("mode", "color")
         p.bg_mode = mode
         if mode == "color":
             p.bg_image = None
-        save_project(p)
-        await q.edit_message_reply_markup(reply_markup=kb_bg())
+        await edit_markup(q, KB_BG)
         return SET_BG
 
     if action == "bgcolor":
         p = get_current_project(context)
         if not p:
-            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
             return MENU
         p.bg_color = kv.get("c", p.bg_color)
-        save_project(p)
-        await q.edit_message_reply_markup(reply_markup=kb_bg())
+        await edit_markup(q, KB_BG)
         return SET_BG
 
     if action == "align":
         p = get_current_project(context)
         if not p:
-            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
             return MENU
         p.align = kv.get("v", p.align)
-        save_project(p)
-        await q.edit_message_reply_markup(reply_markup=kb_align_style())
+        await edit_markup(q, KB_ALIGN_STYLE)
         return SET_STYLE
 
     if action == "fcolor":
         p = get_current_project(context)
         if not p:
-            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
             return MENU
         p.font_color = kv.get("c", p.font_color)
-        save_project(p)
-        await q.edit_message_reply_markup(reply_markup=kb_align_style())
+        await edit_markup(q, KB_ALIGN_STYLE)
         return SET_STYLE
 
     if action == "qr":
         p = get_current_project(context)
         if not p:
-            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
             return MENU
         enable = kv.get("enable") == "1"
         p.qr_enabled = enable
-        save_project(p)
-        await q.edit_message_reply_markup(reply_markup=kb_qr(p.qr_enabled))
+        await edit_markup(q, kb_qr(p.qr_enabled))
         return SET_QR
 
     if action == "qrpos":
         p = get_current_project(context)
         if not p:
-            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
             return MENU
         p.qr_pos = kv.get("p", p.qr_pos)
-        save_project(p)
-        await q.edit_message_reply_markup(reply_markup=kb_qr(p.qr_enabled))
+        await edit_markup(q, kb_qr(p.qr_enabled))
         return SET_QR
 
     if action == "qrsize":
         p = get_current_project(context)
         if not p:
-            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
             return MENU
         try:
             delta = int(kv.get("d", "0"))
         except ValueError:
             delta = 0
         p.qr_size = max(120, min(400, p.qr_size + delta))
-        save_project(p)
-        await q.edit_message_reply_markup(reply_markup=kb_qr(p.qr_enabled))
+        await edit_markup(q, kb_qr(p.qr_enabled))
         return SET_QR
 
     if action == "to":
         s = kv.get("s", "")
         if s == "SET_BG":
-            await q.edit_message_text("Фон. Выбери цвет или пришли фото.", reply_markup=kb_bg())
+            await q.edit_message_text("Фон. Выбери цвет или пришли фото.", reply_markup=KB_BG)
             return SET_BG
         if s == "SET_TITLE":
             await q.edit_message_text("Напиши заголовок (одно сообщение). ✍️")
             return SET_TITLE
         if s == "SET_STYLE":
-            await q.edit_message_text("Стиль текста:", reply_markup=kb_align_style())
+            await q.edit_message_text("Стиль текста:", reply_markup=KB_ALIGN_STYLE)
             return SET_STYLE
         if s == "SET_QR":
             p = get_current_project(context)
             if not p:
-                await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+                await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
                 return MENU
             await q.edit_message_text(
                 ("QR-код. Включи/выключи, позиция, размер.\n"
@@ -562,26 +799,32 @@ async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         if s == "PREVIEW":
             p = get_current_project(context)
             if not p:
-                await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+                await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
                 return MENU
-            path = await render_async(p, final=False)
-            await q.edit_message_media(
-                media=InputFile(path),
-                reply_markup=kb_preview(p.id)
-            )
+            await save_project(p)
+            data = await render_async(p, final=False)
+            photo = InputFile(io.BytesIO(data), filename="preview.jpg")
+            if q.message.photo:
+                await q.edit_message_media(
+                    media=InputMediaPhoto(media=photo),
+                    reply_markup=kb_preview(p.id)
+                )
+            else:
+                # текстовое сообщение в фото не превратить — шлём превью новым
+                await q.message.reply_photo(photo, reply_markup=kb_preview(p.id))
             return PREVIEW
         return MENU
 
     if action == "back":
         to = kv.get("to", "menu")
         if to == "menu":
-            await q.edit_message_text("Главное меню:", reply_markup=kb_menu())
+            await q.edit_message_text("Главное меню:", reply_markup=KB_MENU)
             return MENU
         if to == "tpl":
-            await q.edit_message_text("Выбери шаблон:", reply_markup=kb_templates())
+            await q.edit_message_text("Выбери шаблон:", reply_markup=KB_TEMPLATES)
             return CHOOSE_TPL
         if to == "style":
-            await q.edit_message_text("Стиль текста:", reply_markup=kb_align_style())
+            await q.edit_message_text("Стиль текста:", reply_markup=KB_ALIGN_STYLE)
             return SET_STYLE
         if to == "text":
             await q.edit_message_text("Напиши заголовок ✍️")
@@ -591,19 +834,20 @@ async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if action == "save":
         p = get_current_project(context)
         if not p:
-            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+            await q.edit_message_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
             return MENU
-        path = await render_async(p, final=True)
+        await save_project_now(p)
+        data = await render_async(p, final=True)
         cap = "Готово! Это финальное изображение."
         if p.qr_url:
             cap += f"\nСсылка для QR: {p.qr_url}"
         await q.edit_message_caption(caption=cap) if q.message.photo else None
-        await q.message.reply_photo(InputFile(path))
+        await q.message.reply_photo(InputFile(io.BytesIO(data), filename="final.jpg"))
         await q.message.reply_text("Хочешь изменить что-то ещё?", reply_markup=kb_preview(p.id))
         return PREVIEW
 
     # по умолчанию
-    await q.edit_message_text("Неизвестное действие. Вернёмся в меню.", reply_markup=kb_menu())
+    await q.edit_message_text("Неизвестное действие. Вернёмся в меню.", reply_markup=KB_MENU)
     return MENU
 
 
@@ -613,7 +857,7 @@ async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     p = get_current_project(context)
     if not p:
-        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
         return MENU
     if context.user_data.get("state") not in (SET_BG,):
         await update.effective_message.reply_text("Фото нужно на шаге *Фон*. Нажми \"Фон\".", parse_mode=ParseMode.MARKDOWN, reply_markup=kb_preview(p.id) if context.user_data.get("state") == PREVIEW else None)
@@ -627,21 +871,26 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return SET_BG
     p.root.mkdir(parents=True, exist_ok=True)
     out = p.root / "bg.jpg"
-    await file.download_to_drive(out)
+    # оригинал на диск не пишем: качаем в память, на диск — уже подогнанный фон
+    buf = io.BytesIO()
+    await file.download_to_memory(buf)
+    buf.seek(0)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, fit_background, buf, out)
     p.bg_mode = "image"
     p.bg_image = str(out)
-    save_project(p)
-    await update.effective_message.reply_text("Фон обновлён. Можешь перейти к тексту.", reply_markup=kb_bg())
+    await save_project(p)
+    await update.effective_message.reply_text("Фон обновлён. Можешь перейти к тексту.", reply_markup=KB_BG)
     return SET_BG
 
 
 async def set_title(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     p = get_current_project(context)
     if not p:
-        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
         return MENU
     p.title = (update.message.text or "").strip()
-    save_project(p)
+    await save_project(p)
     await update.effective_message.reply_text("Отлично. Теперь пришли подзаголовок (если не нужен — пришли минус '-'):")
     return SET_SUBTITLE
 
@@ -649,11 +898,11 @@ async def set_title(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def set_subtitle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     p = get_current_project(context)
     if not p:
-        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
         return MENU
     txt = (update.message.text or "").strip()
     p.subtitle = "" if txt == "-" else txt
-    save_project(p)
+    await save_project(p)
     await update.effective_message.reply_text("Теперь основной текст (можно несколько предложений):")
     return SET_BODY
 
@@ -661,20 +910,20 @@ async def set_subtitle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 async def set_body(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     p = get_current_project(context)
     if not p:
-        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
         return MENU
     p.body = (update.message.text or "").strip()
-    save_project(p)
+    await save_project(p)
     # Покажем предпросмотр сразу
-    path = await render_async(p, final=False)
-    await update.effective_message.reply_photo(InputFile(path), caption="Предпросмотр. Можно настроить стиль, QR или сохранить.", reply_markup=kb_preview(p.id))
+    data = await render_async(p, final=False)
+    await update.effective_message.reply_photo(InputFile(io.BytesIO(data), filename="preview.jpg"), caption="Предпросмотр. Можно настроить стиль, QR или сохранить.", reply_markup=kb_preview(p.id))
     return PREVIEW
 
 
 async def set_qr_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     p = get_current_project(context)
     if not p:
-        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+        await update.effective_message.reply_text("Сначала начнём новый проект.", reply_markup=KB_MENU)
         return MENU
     url = (update.message.text or "").strip()
     if not (url.startswith("http://") or url.startswith("https://")):
@@ -682,7 +931,7 @@ async def set_qr_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         return SET_QR
     p.qr_url = url
     p.qr_enabled = True
-    save_project(p)
+    await save_project(p)
     await update.effective_message.reply_text("URL для QR сохранён.", reply_markup=kb_qr(True))
     return SET_QR
 
@@ -690,9 +939,83 @@ async def set_qr_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 # -------------------------------
 # Рендер асинхронно (не блочим)
 # -------------------------------
-async def render_async(p: Project, *, final: bool) -> Path:
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, render_image, p, final)
+# последний рендер каждого файла: out -> (хэш проекта, JPEG). Только последний:
+# он же лежит в out на диске, старые ключи после перезаписи файла не верны
+RENDER_CACHE_MAX = 32
+_render_cache: OrderedDict[Path, Tuple[bytes, bytes]] = OrderedDict()
+# out -> [lock, сколько рендеров его ждёт/держит]; запись уходит с последним
+_render_locks: Dict[Path, list] = {}
+
+
+def render_key(p: Project, final: bool) -> bytes:
+    """Хэш всех полей проекта, от которых зависит картинка."""
+    bg_image_mtime = None
+    if p.bg_mode == "image" and p.bg_image:
+        try:
+            bg_image_mtime = os.stat(p.bg_image).st_mtime_ns
+        except OSError:
+            pass
+    sig = (
+        str(p.root), p.template, p.bg_mode, p.bg_color, p.bg_image, bg_image_mtime,
+        p.title, p.subtitle, p.body, p.font_name, p.font_color, p.align,
+        p.qr_enabled, p.qr_url, p.qr_pos, p.qr_size, final,
+    )
+    return hashlib.blake2b(repr(sig).encode()).digest()
+
+
+_render_pool: ProcessPoolExecutor | None = None
+
+
+def _init_render_worker() -> None:
+    # кэш шрифтов у каждого процесса свой — открываем шрифт по умолчанию сразу
+    for size in FONT_SIZES:
+        get_font(DEFAULT_FONT, size)
+
+
+def start_render_pool() -> None:
+    """Рендер в отдельных процессах: Pillow-текст не упирается в GIL."""
+    global _render_pool
+    if _render_pool is None:
+        # воркеры стартуют лениво, когда в процессе уже есть потоки (aiofiles, executor);
+        # fork многопоточного процесса может повиснуть — берём forkserver
+        _render_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_render_worker,
+        )
+
+
+def stop_render_pool() -> None:
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+
+async def render_async(p: Project, *, final: bool) -> bytes:
+    key = render_key(p, final)
+    out = p.root / ("final.jpg" if final else "preview.jpg")
+    # рендеры одного файла по очереди: двойной тап ждёт первый, а не считает заново,
+    # и два разных рендера не пишут out наперегонки
+    entry = _render_locks.setdefault(out, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            cached = _render_cache.get(out)
+            if cached is not None and cached[0] == key:
+                _render_cache.move_to_end(out)
+                return cached[1]
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(_render_pool, render_image, p, final)
+            _render_cache[out] = (key, data)
+            _render_cache.move_to_end(out)
+            while len(_render_cache) > RENDER_CACHE_MAX:
+                _render_cache.popitem(last=False)
+            return data
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _render_locks[out]
 
 
 # ------------------
@@ -711,8 +1034,17 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
 # Main() / запуск
 # ------------------
 
+async def on_shutdown(app) -> None:
+    # не теряем отложенные записи meta.json и несохранённые правки из user_data
+    await flush_projects(
+        p for ud in app.user_data.values() if (p := ud.get("project")) is not None
+    )
+    stop_render_pool()
+
+
 def build_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    start_render_pool()
+    app = ApplicationBuilder().token(BOT_TOKEN).post_shutdown(on_shutdown).build()
 
     conv = ConversationHandler(
         entry_points=[
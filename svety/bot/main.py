@@ -2,24 +2,30 @@
 from __future__ import annotations
 
 import asyncio
-import json
+import concurrent.futures
+import functools
+import hashlib
+import io
 import logging
+import multiprocessing
 import os
 import time
 import uuid
+from collections import OrderedDict
 from dataclasses import dataclass
-from datetime import datetime
 from pathlib import Path
-from types import SimpleNamespace
-from typing import Dict, Tuple, Any, List
+from typing import Awaitable, Callable, Dict, Tuple, Any, List
 
+import orjson
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InputFile,
+    Message,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder,
     CallbackQueryHandler,
@@ -30,8 +36,8 @@ from telegram.ext import (
     filters,
 )
 
-from svety.core.config import cfg
-from svety.core.rendering import render_image
+from svety.core.config import cfg, ensure_dir
+from svety.core.rendering import DEFAULT_FONT, prepare_background, render_bytes, warm_caches, write_render
 
 # -----------------------------
 # ЛОГИ И ТОКЕН
@@ -54,15 +60,11 @@ MENU, CHOOSE_TPL, SET_BG, SET_TITLE, SET_SUBTITLE, SET_BODY, SET_STYLE, SET_QR,
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # -----------------------------
 def _user_dir(user_id: int) -> Path:
-    p = cfg.DATA_DIR / str(user_id)
-    p.mkdir(parents=True, exist_ok=True)
-    return p
+    return ensure_dir(cfg.DATA_DIR / str(user_id))
 
 
 def _project_dir(user_id: int, pid: str) -> Path:
-    p = _user_dir(user_id) / pid
-    p.mkdir(parents=True, exist_ok=True)
-    return p
+    return ensure_dir(cfg.DATA_DIR / str(user_id) / pid)
 
 
 def _meta_path(user_id: int, pid: str) -> Path:
@@ -81,7 +83,7 @@ def new_project(user_id: int) -> Dict[str, Any]:
         "title": "",
         "subtitle": "",
         "body": "",
-        "font_name": "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        "font_name": DEFAULT_FONT,
         "font_color": "#111111",
         "align": "center",
         "qr_enabled": False,
@@ -94,44 +96,150 @@ def new_project(user_id: int) -> Dict[str, Any]:
     return proj
 
 
+# Проекты живут в памяти; на диск уходят не чаще раза в FLUSH_DELAY_S
+FLUSH_DELAY_S = 0.5
+PROJECT_CACHE_MAX = 1024
+ProjectKey = Tuple[int, str]
+# key -> (проект, dirty); порядок — от давно не тронутых к свежим (LRU)
+PROJECT_CACHE: "OrderedDict[ProjectKey, Tuple[Dict[str, Any], bool]]" = OrderedDict()
+_FLUSH_HANDLES: Dict[ProjectKey, asyncio.TimerHandle] = {}
+# не больше одного писателя на проект; запись живёт, пока проект пишется
+_FLUSH_WRITERS: Dict[ProjectKey, asyncio.Task] = {}
+
+
+def _write_meta(key: ProjectKey, data: bytes) -> None:
+    meta = _meta_path(*key)
+    # пишем во временный файл и подменяем: meta.json не бывает недописанным
+    tmp = meta.with_suffix(".json.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, meta)
+
+
+def _dump(p: Dict[str, Any]) -> bytes:
+    return orjson.dumps(p, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+
+def _trim_cache() -> None:
+    # вытесняем давно не тронутые чистые записи; грязные ждут своей записи на диск,
+    # а идущая запись помечает проект чистым ещё до того, как meta.json обновится
+    for key in list(PROJECT_CACHE):
+        if len(PROJECT_CACHE) <= PROJECT_CACHE_MAX:
+            break
+        if not PROJECT_CACHE[key][1] and key not in _FLUSH_HANDLES and key not in _FLUSH_WRITERS:
+            del PROJECT_CACHE[key]
+
+
+async def _flush_async(key: ProjectKey) -> None:
+    # запись одного проекта строго по очереди, иначе старые данные могут лечь поверх новых;
+    # правки, пришедшие во время записи, пишем следующим заходом
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            entry = PROJECT_CACHE.get(key)
+            if entry is None or not entry[1]:
+                return
+            p = entry[0]
+            data = _dump(p)
+            PROJECT_CACHE[key] = (p, False)
+            try:
+                await loop.run_in_executor(None, _write_meta, key, data)
+            except Exception:
+                log.exception("Не удалось сохранить проект %s", key[1])
+                PROJECT_CACHE[key] = (p, True)
+                return
+    finally:
+        _FLUSH_WRITERS.pop(key, None)
+
+
+def _start_flush(key: ProjectKey) -> asyncio.Task:
+    task = _FLUSH_WRITERS.get(key)
+    if task is None:
+        task = _FLUSH_WRITERS[key] = asyncio.ensure_future(_flush_async(key))
+    return task
+
+
+def _flush(key: ProjectKey) -> None:
+    _FLUSH_HANDLES.pop(key, None)
+    _start_flush(key)
+
+
+async def flush_now(key: ProjectKey) -> None:
+    """Записать проект на диск сейчас (перед финальным рендером)."""
+    handle = _FLUSH_HANDLES.pop(key, None)
+    if handle is not None:
+        handle.cancel()
+    await _start_flush(key)
+
+
+async def flush_all() -> None:
+    for key in list(_FLUSH_HANDLES):
+        _FLUSH_HANDLES.pop(key).cancel()
+    for key, (_, dirty) in list(PROJECT_CACHE.items()):
+        if dirty:
+            _start_flush(key)
+    await asyncio.gather(*list(_FLUSH_WRITERS.values()))
+
+
 def save_project(p: Dict[str, Any]) -> None:
     p["updated_at"] = time.time()
-    meta = _meta_path(p["user_id"], p["id"])
-    meta.write_text(json.dumps(p, ensure_ascii=False, indent=2), encoding="utf-8")
+    key = (p["user_id"], p["id"])
+    PROJECT_CACHE[key] = (p, True)
+    PROJECT_CACHE.move_to_end(key)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # вне event loop откладывать некуда — пишем сразу
+        _write_meta(key, _dump(p))
+        PROJECT_CACHE[key] = (p, False)
+        return
+    if key not in _FLUSH_HANDLES:
+        _FLUSH_HANDLES[key] = loop.call_later(FLUSH_DELAY_S, _flush, key)
+    _trim_cache()
 
 
 def load_project(user_id: int, pid: str) -> Dict[str, Any] | None:
+    key = (user_id, pid)
+    entry = PROJECT_CACHE.get(key)
+    if entry is not None:
+        PROJECT_CACHE.move_to_end(key)
+        return entry[0]
     meta = _meta_path(user_id, pid)
     if not meta.exists():
         return None
     try:
-        return json.loads(meta.read_text(encoding="utf-8"))
+        p = orjson.loads(meta.read_bytes())
     except Exception:
         return None
+    PROJECT_CACHE[key] = (p, False)
+    _trim_cache()
+    return p
 
 
 def list_projects(user_id: int, limit: int = 8) -> List[Dict[str, Any]]:
     base = _user_dir(user_id)
     items: List[Dict[str, Any]] = []
-    if not base.exists():
+    # scandir отдаёт stat из DirEntry без лишних syscall-ов и без Path-объектов
+    try:
+        with os.scandir(base) as it:
+            entries = [
+                (e.stat(follow_symlinks=False).st_mtime, e.path)
+                for e in it
+                if e.is_dir(follow_symlinks=False)
+            ]
+    except FileNotFoundError:
         return items
-    for child in sorted(base.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True):
-        m = child / "meta.json"
-        if m.exists():
-            try:
-                d = json.loads(m.read_text(encoding="utf-8"))
-                items.append(d)
-            except Exception:
-                continue
+    entries.sort(reverse=True)
+    for _, path in entries:
+        try:
+            with open(os.path.join(path, "meta.json"), "rb") as f:
+                items.append(orjson.loads(f.read()))
+        except Exception:
+            continue
         if len(items) >= limit:
             break
     return items
 
 
-def as_obj(d: Dict[str, Any]) -> SimpleNamespace:
-    return SimpleNamespace(**d)
-
-
 # -----------------------------
 # КЛАВИАТУРЫ
 # -----------------------------
@@ -251,15 +359,13 @@ def parse_cb(data: str) -> Tuple[str, Dict[str, str]]:
     """
     if not data or not data.startswith("a:"):
         return data or "", {}
-    payload = data[2:]
-    if "|" not in payload:
-        return payload, {}
-    action, rest = payload.split("|", 1)
+    action, _, rest = data[2:].partition("|")
     kv: Dict[str, str] = {}
-    for part in rest.split("|"):
-        if "=" in part:
-            k, v = part.split("=", 1)
-            kv[k] = v
+    if rest:
+        for part in rest.split("|"):
+            k, eq, v = part.partition("=")
+            if eq:
+                kv[k] = v
     return action, kv
 
 
@@ -287,193 +393,226 @@ async def cmd_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # -----------------------------
 # CALLBACK FLOW
 # -----------------------------
-async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    q = update.callback_query
-    await q.answer()
-    action, kv = parse_cb(q.data or "")
-    uid = update.effective_user.id
+def _get_proj(context: ContextTypes.DEFAULT_TYPE, uid: int) -> Dict[str, Any] | None:
+    # текущий проект пользователя (pid лежит в user_data)
+    pid = context.user_data.get("pid")
+    if not pid:
+        return None
+    return load_project(uid, pid)
 
-    # вспом. функция получения/сохранения текущего проекта
-    def get_proj() -> Dict[str, Any] | None:
-        pid = context.user_data.get("pid")
-        if not pid:
-            return None
-        return load_project(uid, pid)
 
-    if action == "new":
-        p = new_project(uid)
-        context.user_data["pid"] = p["id"]
-        await q.message.reply_text("Выбери шаблон:", reply_markup=kb_templates())
-        return CHOOSE_TPL
+async def _no_project(q) -> int:
+    await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
+    return MENU
+
+
+async def _a_new(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = new_project(uid)
+    context.user_data["pid"] = p["id"]
+    await q.message.reply_text("Выбери шаблон:", reply_markup=kb_templates())
+    return CHOOSE_TPL
 
-    if action == "list":
-        items = list_projects(uid)
-        if not items:
-            await q.message.reply_text("У тебя пока нет проектов. Нажми «Создать открытку».", reply_markup=kb_menu())
-            return MENU
-        lines = ["Твои последние проекты:"]
-        for it in items:
-            dt = datetime.fromtimestamp(it.get("updated_at", time.time())).strftime("%Y-%m-%d %H:%M")
-            lines.append(f"• {it.get('id')} — {dt}")
-        await q.message.reply_text("\n".join(lines), reply_markup=kb_menu())
+
+async def _a_list(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    items = list_projects(uid)
+    if not items:
+        await q.message.reply_text("У тебя пока нет проектов. Нажми «Создать открытку».", reply_markup=kb_menu())
         return MENU
+    now = time.time()
+    lines = ["Твои последние проекты:"] + [
+        f"• {it.get('id')} — {time.strftime('%Y-%m-%d %H:%M', time.localtime(it.get('updated_at', now)))}"
+        for it in items
+    ]
+    await q.message.reply_text("\n".join(lines), reply_markup=kb_menu())
+    return MENU
 
-    if action == "tpl":
-        p = get_proj()
-        if not p:
-            await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-            return MENU
-        p["template"] = kv.get("id", p["template"])
-        save_project(p)
-        await q.message.reply_text("Фон. Выбери цвет или пришли фото (как изображение, не как файл).", reply_markup=kb_bg())
-        return SET_BG
 
-    if action == "bg":
-        p = get_proj()
-        if not p:
-            await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-            return MENU
-        mode = kv.get("mode", "color")
-        p["bg_mode"] = mode
-        if mode == "color":
-            p["bg_image"] = None
-        save_project(p)
-        await q.message.reply_markup(reply_markup=kb_bg())
-        return SET_BG
+async def _a_tpl(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = _get_proj(context, uid)
+    if not p:
+        return await _no_project(q)
+    p["template"] = kv.get("id", p["template"])
+    save_project(p)
+    await q.message.reply_text("Фон. Выбери цвет или пришли фото (как изображение, не как файл).", reply_markup=kb_bg())
+    return SET_BG
 
-    if action == "bgcolor":
-        p = get_proj()
-        if not p:
-            await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-            return MENU
-        p["bg_color"] = kv.get("c", p["bg_color"])
-        save_project(p)
-        await q.message.reply_markup(reply_markup=kb_bg())
-        return SET_BG
 
-    if action == "align":
-        p = get_proj()
-        if not p:
-            await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-            return MENU
-        p["align"] = kv.get("v", p["align"])
-        save_project(p)
-        await q.message.reply_markup(reply_markup=kb_align_style())
-        return SET_STYLE
+async def _a_bg(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = _get_proj(context, uid)
+    if not p:
+        return await _no_project(q)
+    mode = kv.get("mode", "color")
+    p["bg_mode"] = mode
+    if mode == "color":
+        p["bg_image"] = None
+    save_project(p)
+    await q.message.reply_markup(reply_markup=kb_bg())
+    return SET_BG
 
-    if action == "fcolor":
-        p = get_proj()
-        if not p:
-            await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-            return MENU
-        p["font_color"] = kv.get("c", p["font_color"])
-        save_project(p)
-        await q.message.reply_markup(reply_markup=kb_align_style())
-        return SET_STYLE
 
-    if action == "qr":
-        p = get_proj()
-        if not p:
-            await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-            return MENU
-        enable = kv.get("enable") == "1"
-        p["qr_enabled"] = enable
-        save_project(p)
-        await q.message.reply_markup(reply_markup=kb_qr(p["qr_enabled"]))
-        return SET_QR
+async def _a_bgcolor(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = _get_proj(context, uid)
+    if not p:
+        return await _no_project(q)
+    p["bg_color"] = kv.get("c", p["bg_color"])
+    save_project(p)
+    await q.message.reply_markup(reply_markup=kb_bg())
+    return SET_BG
 
-    if action == "qrpos":
-        p = get_proj()
-        if not p:
-            await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-            return MENU
-        p["qr_pos"] = kv.get("p", p["qr_pos"])
-        save_project(p)
-        await q.message.reply_markup(reply_markup=kb_qr(p["qr_enabled"]))
-        return SET_QR
 
-    if action == "qrsize":
-        p = get_proj()
-        if not p:
-            await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-            return MENU
-        try:
-            delta = int(kv.get("d", "0"))
-        except ValueError:
-            delta = 0
-        p["qr_size"] = max(120, min(400, p["qr_size"] + delta))
-        save_project(p)
-        await q.message.reply_markup(reply_markup=kb_qr(p["qr_enabled"]))
-        return SET_QR
+async def _a_align(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = _get_proj(context, uid)
+    if not p:
+        return await _no_project(q)
+    p["align"] = kv.get("v", p["align"])
+    save_project(p)
+    await q.message.reply_markup(reply_markup=kb_align_style())
+    return SET_STYLE
 
-    if action == "to":
-        s = kv.get("s", "")
-        if s == "SET_BG":
-            await q.message.reply_text("Фон. Выбери цвет или пришли фото.", reply_markup=kb_bg())
-            return SET_BG
-        if s == "SET_TITLE":
-            await q.message.reply_text("Напиши заголовок (одно сообщение). ✍️")
-            return SET_TITLE
-        if s == "SET_STYLE":
-            await q.message.reply_text("Стиль текста:", reply_markup=kb_align_style())
-            return SET_STYLE
-        if s == "SET_QR":
-            p = get_proj()
-            if not p:
-                await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-                return MENU
-            await q.message.reply_text(
-                ("QR-код. Включи/выключи, позиция, размер.\n"
-                 f"Текущий URL: {p.get('qr_url') or 'не задан'}. Чтобы поменять URL — пришли ссылку текстом."),
-                reply_markup=kb_qr(p["qr_enabled"]),
-            )
-            return SET_QR
-        if s == "PREVIEW":
-            p = get_proj()
-            if not p:
-                await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-                return MENU
-            path = await render_async(as_obj(p), final=False)
-            await q.message.reply_photo(InputFile(path), caption="Предпросмотр. Можно настроить стиль, QR или сохранить.", reply_markup=kb_preview(p["id"]))
-            return PREVIEW
-        return MENU
 
-    if action == "back":
-        to = kv.get("to", "menu")
-        if to == "menu":
-            await q.message.reply_text("Главное меню:", reply_markup=kb_menu())
-            return MENU
-        if to == "tpl":
-            await q.message.reply_text("Выбери шаблон:", reply_markup=kb_templates())
-            return CHOOSE_TPL
-        if to == "style":
-            await q.message.reply_text("Стиль текста:", reply_markup=kb_align_style())
-            return SET_STYLE
-        if to == "text":
-            await q.message.reply_text("Напиши заголовок ✍️")
-            return SET_TITLE
-        return MENU
+async def _a_fcolor(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = _get_proj(context, uid)
+    if not p:
+        return await _no_project(q)
+    p["font_color"] = kv.get("c", p["font_color"])
+    save_project(p)
+    await q.message.reply_markup(reply_markup=kb_align_style())
+    return SET_STYLE
+
+
+async def _a_qr(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = _get_proj(context, uid)
+    if not p:
+        return await _no_project(q)
+    enable = kv.get("enable") == "1"
+    p["qr_enabled"] = enable
+    save_project(p)
+    await q.message.reply_markup(reply_markup=kb_qr(p["qr_enabled"]))
+    return SET_QR
+
+
+async def _a_qrpos(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = _get_proj(context, uid)
+    if not p:
+        return await _no_project(q)
+    p["qr_pos"] = kv.get("p", p["qr_pos"])
+    save_project(p)
+    await q.message.reply_markup(reply_markup=kb_qr(p["qr_enabled"]))
+    return SET_QR
+
 
-    if action == "save":
-        p = get_proj()
+async def _a_qrsize(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = _get_proj(context, uid)
+    if not p:
+        return await _no_project(q)
+    try:
+        delta = int(kv.get("d", "0"))
+    except ValueError:
+        delta = 0
+    p["qr_size"] = max(120, min(400, p["qr_size"] + delta))
+    save_project(p)
+    await q.message.reply_markup(reply_markup=kb_qr(p["qr_enabled"]))
+    return SET_QR
+
+
+async def _a_to(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    s = kv.get("s", "")
+    if s == "SET_BG":
+        await q.message.reply_text("Фон. Выбери цвет или пришли фото.", reply_markup=kb_bg())
+        return SET_BG
+    if s == "SET_TITLE":
+        await q.message.reply_text("Напиши заголовок (одно сообщение). ✍️")
+        return SET_TITLE
+    if s == "SET_STYLE":
+        await q.message.reply_text("Стиль текста:", reply_markup=kb_align_style())
+        return SET_STYLE
+    if s == "SET_QR":
+        p = _get_proj(context, uid)
         if not p:
-            await q.message.reply_text("Сначала начнём новый проект.", reply_markup=kb_menu())
-            return MENU
-        path = await render_async(as_obj(p), final=True)
-        cap = "Готово! Это финальное изображение."
-        if p.get("qr_url"):
-            cap += f"\nСсылка для QR: {p['qr_url']}"
-        await q.message.reply_photo(InputFile(path), caption=cap, reply_markup=kb_preview(p["id"]))
+            return await _no_project(q)
+        await q.message.reply_text(
+            ("QR-код. Включи/выключи, позиция, размер.\n"
+             f"Текущий URL: {p.get('qr_url') or 'не задан'}. Чтобы поменять URL — пришли ссылку текстом."),
+            reply_markup=kb_qr(p["qr_enabled"]),
+        )
+        return SET_QR
+    if s == "PREVIEW":
+        p = _get_proj(context, uid)
+        if not p:
+            return await _no_project(q)
+        await send_preview(q.message, p)
         return PREVIEW
+    return MENU
 
-    # неизвестное действие
-    await q.message.reply_text("Неизвестное действие. Вернёмся в меню.", reply_markup=kb_menu())
+
+async def _a_back(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    to = kv.get("to", "menu")
+    if to == "menu":
+        await q.message.reply_text("Главное меню:", reply_markup=kb_menu())
+        return MENU
+    if to == "tpl":
+        await q.message.reply_text("Выбери шаблон:", reply_markup=kb_templates())
+        return CHOOSE_TPL
+    if to == "style":
+        await q.message.reply_text("Стиль текста:", reply_markup=kb_align_style())
+        return SET_STYLE
+    if to == "text":
+        await q.message.reply_text("Напиши заголовок ✍️")
+        return SET_TITLE
     return MENU
 
 
+async def _a_save(q, kv: Dict[str, str], context: ContextTypes.DEFAULT_TYPE, uid: int) -> int:
+    p = _get_proj(context, uid)
+    if not p:
+        return await _no_project(q)
+    await flush_now((uid, p["id"]))
+    data = await render_async(p, final=True)
+    cap = "Готово! Это финальное изображение."
+    if p.get("qr_url"):
+        cap += f"\nСсылка для QR: {p['qr_url']}"
+    await q.message.reply_photo(InputFile(io.BytesIO(data), filename="final.jpg"), caption=cap, reply_markup=kb_preview(p["id"]))
+    return PREVIEW
+
+
+# action из callback_data -> обработчик (q, kv, context, uid) -> следующее состояние
+ACTIONS: Dict[str, Callable[..., Awaitable[int]]] = {
+    "new": _a_new,
+    "list": _a_list,
+    "tpl": _a_tpl,
+    "bg": _a_bg,
+    "bgcolor": _a_bgcolor,
+    "align": _a_align,
+    "fcolor": _a_fcolor,
+    "qr": _a_qr,
+    "qrpos": _a_qrpos,
+    "qrsize": _a_qrsize,
+    "to": _a_to,
+    "back": _a_back,
+    "save": _a_save,
+}
+
+
+async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    q = update.callback_query
+    await q.answer()
+    action, kv = parse_cb(q.data or "")
+    handler = ACTIONS.get(action)
+    if handler is None:
+        # неизвестное действие
+        await q.message.reply_text("Неизвестное действие. Вернёмся в меню.", reply_markup=kb_menu())
+        return MENU
+    return await handler(q, kv, context, update.effective_user.id)
+
+
 # -----------------------------
 # ОБРАБОТКА СООБЩЕНИЙ
 # -----------------------------
+def _store_background(out: Path, data: bytes) -> None:
+    write_render(out, data)
+    prepare_background(out)
+
+
 async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     uid = update.effective_user.id
     pid = context.user_data.get("pid")
@@ -496,13 +635,16 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return state or MENU
 
     photo = update.message.photo[-1]
-    tgfile = await photo.get_file()
     if photo.file_size and photo.file_size > cfg.MAX_UPLOAD_MB * 1024 * 1024:
         await update.effective_message.reply_text(f"Файл слишком большой (>{cfg.MAX_UPLOAD_MB} МБ). Пришли поменьше.")
         return SET_BG
+    tgfile = await photo.get_file()
 
     out = _project_dir(uid, pid) / "bg.jpg"
-    await tgfile.download_to_drive(out)
+    # один GET целиком в память, запись и масштабирование под полотно — одним заходом в executor
+    data = await tgfile.download_as_bytearray()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _store_background, out, bytes(data))
 
     p["bg_mode"] = "image"
     p["bg_image"] = str(out)
@@ -556,12 +698,7 @@ async def set_body(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     save_project(p)
 
     # Покажем предпросмотр
-    path = await render_async(as_obj(p), final=False)
-    await update.effective_message.reply_photo(
-        InputFile(path),
-        caption="Предпросмотр. Можно настроить стиль, QR или сохранить.",
-        reply_markup=kb_preview(p["id"]),
-    )
+    await send_preview(update.effective_message, p)
     return PREVIEW
 
 
@@ -587,9 +724,150 @@ async def set_qr_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 # -----------------------------
 # РЕНДЕР В EXECUTOR (НЕ БЛОЧИМ)
 # -----------------------------
-async def render_async(p_obj: Any, *, final: bool) -> Path:
+# Рендер — питоновский код (перенос, QR), в потоках он упирается в GIL.
+# Пул создаёт build_app(); процессы стартуют лениво, при первом рендере.
+RENDER_POOL: concurrent.futures.ProcessPoolExecutor | None = None
+
+
+def start_render_pool() -> None:
+    global RENDER_POOL
+    if RENDER_POOL is None:
+        # к первому рендеру в процессе уже есть потоки executor-а (meta.json, фоны);
+        # fork такого процесса может унести в воркер чужой захваченный lock
+        RENDER_POOL = concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=warm_caches,
+            initargs=(DEFAULT_FONT,),
+        )
+
+
+# поля, от которых зависит картинка; всё прочее (updated_at и т.п.) рендер не трогает
+_RENDER_FIELDS = (
+    "template", "bg_mode", "bg_color", "bg_image", "title", "subtitle", "body",
+    "font_name", "font_color", "align", "qr_enabled", "qr_url", "qr_pos", "qr_size",
+)
+
+
+def _render_sig(p: Dict[str, Any], final: bool) -> str:
+    bg_mtime = None
+    if p.get("bg_image"):
+        try:
+            bg_mtime = os.stat(p["bg_image"]).st_mtime_ns
+        except OSError:
+            pass
+    state = (final, bg_mtime) + tuple(p.get(k) for k in _RENDER_FIELDS)
+    return hashlib.blake2b(repr(state).encode(), digest_size=16).hexdigest()
+
+
+# отрендеренные файлы, ещё не записанные на диск: out -> bytes (последний рендер)
+_OUT_PENDING: Dict[Path, bytes] = {}
+# не больше одного писателя на файл; запись живёт, пока файл пишется
+_OUT_WRITERS: Dict[Path, asyncio.Task] = {}
+
+
+async def _persist_render(out: Path) -> None:
+    # пишем, пока есть что: рендер, пришедший во время записи, ляжет следующим
+    loop = asyncio.get_running_loop()
+    try:
+        while (data := _OUT_PENDING.get(out)) is not None:
+            try:
+                await loop.run_in_executor(None, write_render, out, data)
+            except Exception:
+                log.exception("Не удалось сохранить изображение %s", out)
+            if _OUT_PENDING.get(out) is data:
+                del _OUT_PENDING[out]
+    finally:
+        _OUT_WRITERS.pop(out, None)
+
+
+def _read_render(out: Path) -> bytes | None:
+    try:
+        return out.read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+async def render_async(p: Dict[str, Any], *, final: bool, sig: str | None = None) -> bytes:
+    """
+    Рендер в executor, возвращает JPEG. Если с прошлого рендера того же вида
+    (превью/финал) ничего не поменялось — отдаём прошлый результат без PIL.
+    Файл на диске обновляется в фоне, пользователь его не ждёт.
+    sig — уже посчитанная _render_sig(p, final), чтобы не делать stat фона ещё раз.
+    """
+    kind = "final" if final else "preview"
+    out = _project_dir(p["user_id"], p["id"]) / f"{kind}.jpg"
+    if sig is None:
+        sig = _render_sig(p, final)
+    sigs = p.setdefault("render_sigs", {})
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, render_image, p_obj, final)
+    if sigs.get(kind) == sig:
+        data = _OUT_PENDING.get(out)
+        if data is None:
+            data = await loop.run_in_executor(None, _read_render, out)
+        if data is not None:
+            return data
+    # в процесс уходит обычный dict, назад — готовый JPEG
+    data = await loop.run_in_executor(RENDER_POOL, functools.partial(render_bytes, p, final=final))
+    _queue_render(p, kind, sig, data)
+    return data
+
+
+def _queue_render(p: Dict[str, Any], kind: str, sig: str, data: bytes) -> None:
+    # data становится последним рендером вида kind: сигнатура в проекте, файл — в фоне
+    out = _project_dir(p["user_id"], p["id"]) / f"{kind}.jpg"
+    p.setdefault("render_sigs", {})[kind] = sig
+    save_project(p)
+    _OUT_PENDING[out] = data
+    if out not in _OUT_WRITERS:
+        _OUT_WRITERS[out] = asyncio.ensure_future(_persist_render(out))
+
+
+# готовые превью в памяти: повторный показ — только отправка, без диска и PIL
+PREVIEW_CACHE_MAX = 50
+_PREVIEW_BYTES: "OrderedDict[str, bytes]" = OrderedDict()
+
+
+async def render_preview(p: Dict[str, Any], sig: str) -> InputFile:
+    data = _PREVIEW_BYTES.get(sig)
+    if data is None:
+        data = await render_async(p, final=False, sig=sig)
+        _PREVIEW_BYTES[sig] = data
+        if len(_PREVIEW_BYTES) > PREVIEW_CACHE_MAX:
+            _PREVIEW_BYTES.popitem(last=False)
+    else:
+        _PREVIEW_BYTES.move_to_end(sig)
+        # превью из памяти, а на диске может лежать другое (правка, потом откат)
+        if p.get("render_sigs", {}).get("preview") != sig:
+            _queue_render(p, "preview", sig, data)
+    return InputFile(io.BytesIO(data), filename="preview.jpg")
+
+
+async def send_preview(message: Message, p: Dict[str, Any]) -> None:
+    """
+    Отправка превью. Если такое превью Telegram уже видел — шлём его file_id
+    без загрузки; file_id хранится в p["preview_file_id"] по сигнатуре рендера.
+    """
+    caption = "Предпросмотр. Можно настроить стиль, QR или сохранить."
+    sig = _render_sig(p, False)
+    sent = None
+    file_id = (p.get("preview_file_id") or {}).get(sig)
+    if file_id:
+        try:
+            sent = await message.reply_photo(file_id, caption=caption, reply_markup=kb_preview(p["id"]))
+        except BadRequest:
+            # file_id протух — загрузим заново
+            log.info("file_id превью для %s не принят, отправляем файл", p["id"])
+    if sent is None:
+        photo = await render_preview(p, sig)
+        sent = await message.reply_photo(photo, caption=caption, reply_markup=kb_preview(p["id"]))
+    elif p.get("render_sigs", {}).get("preview") != sig:
+        # ушло по file_id, а preview.jpg на диске от другой версии — догоняем уже после отправки
+        await render_preview(p, sig)
+    if sent.photo and sent.photo[-1].file_id != file_id:
+        # храним только актуальное превью: любая правка меняет сигнатуру
+        p["preview_file_id"] = {sig: sent.photo[-1].file_id}
+        save_project(p)
 
 
 # -----------------------------
@@ -607,8 +885,21 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
 # -----------------------------
 # СБОРКА ПРИЛОЖЕНИЯ
 # -----------------------------
+async def _on_shutdown(app) -> None:
+    # отложенные записи meta.json не теряем
+    await flush_all()
+    # как и meta.json, недописанные рендеры дожидаемся
+    await asyncio.gather(*list(_OUT_WRITERS.values()))
+    if RENDER_POOL is not None:
+        RENDER_POOL.shutdown(cancel_futures=True)
+
+
 def build_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    start_render_pool()
+    # апдейты PTB обрабатывает по одному (ConversationHandler с concurrent_updates
+    # теряет согласованность состояний), так что пул разгружает event loop,
+    # но параллельных рендеров для разных пользователей пока не даёт
+    app = ApplicationBuilder().token(BOT_TOKEN).post_shutdown(_on_shutdown).build()
 
     conv = ConversationHandler(
         entry_points=[
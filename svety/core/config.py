@@ -45,5 +45,17 @@ class Config:
         )
 
 
+# каталоги, уже созданные этим процессом: mkdir на каждый вызов — лишние syscalls
+_ENSURED: set[str] = set()
+
+
+def ensure_dir(p: Path) -> Path:
+    s = str(p)
+    if s not in _ENSURED:
+        p.mkdir(parents=True, exist_ok=True)
+        _ENSURED.add(s)
+    return p
+
+
 # Единый объект конфигурации для импорта
 cfg: Config = Config.from_env()
@@ -1,43 +1,54 @@
 # svety/core/rendering.py
 from __future__ import annotations
 
+import functools
+import io
 import logging
+import os
+import string
 from pathlib import Path
-from typing import Any, Tuple
+from typing import Any, Dict, Tuple
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import qrcode
 
-from .config import cfg
-
 log = logging.getLogger(__name__)
 
 # Полотно и отступы (вертикальный формат 4:5 удобно для превью/мобилы)
 CANVAS: Tuple[int, int] = (1200, 1500)
 MARGIN = 80
+DEFAULT_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+FONT_SIZES: Tuple[int, int, int] = (90, 56, 44)  # заголовок, подзаголовок, текст
 
 
 def _hex_to_rgb(hex_color: str) -> Tuple[int, int, int]:
     s = (hex_color or "#ffffff").strip().lstrip("#")
-    if len(s) == 3:
-        s = "".join(c * 2 for c in s)
+    # int(s, 16) пропускает "_" и знак — такие строки считаем мусором, как раньше
+    if not all(c in string.hexdigits for c in s):
+        return 255, 255, 255
     try:
-        r = int(s[0:2], 16)
-        g = int(s[2:4], 16)
-        b = int(s[4:6], 16)
-        return r, g, b
+        if len(s) == 3:
+            v = int(s[0] * 2 + s[1] * 2 + s[2] * 2, 16)
+        elif len(s) >= 6:
+            v = int(s[:6], 16)
+        else:
+            return 255, 255, 255
+        return (v >> 16) & 0xFF, (v >> 8) & 0xFF, v & 0xFF
     except Exception:
         return 255, 255, 255
 
 
+@functools.lru_cache(maxsize=64)
 def _get_font(font_name: str, size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
     """
     Пытаемся открыть указанный шрифт; если не получилось — падаем на системные DejaVu/FreeSans,
     иначе — на встроенный bitmap-шрифт (нежелательно, но безопасно).
+    Результат кэшируется: TTF разбирается один раз на (шрифт, размер) за жизнь процесса.
     """
     candidates = [
         font_name,
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        DEFAULT_FONT,
         "/usr/share/fonts/truetype/freefont/FreeSans.ttf",
     ]
     for p in candidates:
@@ -49,6 +60,52 @@ def _get_font(font_name: str, size: int) -> ImageFont.FreeTypeFont | ImageFont.I
     return ImageFont.load_default()
 
 
+def _line_height(font: ImageFont.FreeTypeFont | ImageFont.ImageFont) -> int:
+    """
+    Высота строки по метрикам шрифта (ascent + descent), одна на шрифт.
+    У bitmap-шрифта метрик нет — берём bbox.
+    """
+    try:
+        ascent, descent = font.getmetrics()
+        return ascent + descent
+    except AttributeError:
+        bbox = font.getbbox("Ay")
+        return bbox[3] - bbox[1]
+
+
+def _wrap(text: str, font: ImageFont.FreeTypeFont | ImageFont.ImageFont, max_w: int) -> Tuple[Tuple[str, int], ...]:
+    """
+    Жадный перенос слов: каждое слово меряется один раз, ширина строки накапливается.
+    Возвращает пары (строка, ширина в px).
+    """
+    space_w = font.getlength(" ")
+    lines: list[Tuple[str, int]] = []
+    line: list[str] = []
+    cur_w = 0.0
+    for w in text.split():
+        ww = font.getlength(w)
+        if not line:
+            line, cur_w = [w], ww
+        elif cur_w + space_w + ww <= max_w:
+            line.append(w)
+            cur_w += space_w + ww
+        else:
+            lines.append((" ".join(line), int(cur_w)))
+            line, cur_w = [w], ww
+    if line:
+        lines.append((" ".join(line), int(cur_w)))
+    return tuple(lines)
+
+
+@functools.lru_cache(maxsize=512)
+def _wrap_lines(text: str, font_key: Tuple[str, int], max_w: int) -> Tuple[Tuple[str, int], ...]:
+    """
+    Кэш переноса: повторный рендер с тем же текстом (финал после превью,
+    правки QR) не пересчитывает раскладку. font_key — (путь к шрифту, размер).
+    """
+    return _wrap(text, _get_font(*font_key), max_w)
+
+
 def _text_block(
     draw: ImageDraw.ImageDraw,
     text: str,
@@ -65,22 +122,15 @@ def _text_block(
         return
     x0, y0, x1, y1 = area
     max_w = x1 - x0
-    words = text.split()
-    lines, line = [], []
-    for w in words:
-        probe = (" ".join(line + [w])).strip()
-        wpx, _ = draw.textsize(probe, font=font)
-        if wpx <= max_w or not line:
-            line.append(w)
-        else:
-            lines.append(" ".join(line))
-            line = [w]
-    if line:
-        lines.append(" ".join(line))
+    path = getattr(font, "path", None)
+    if isinstance(path, str):
+        lines = _wrap_lines(text, (path, font.size), max_w)
+    else:  # bitmap-шрифт: ключа для кэша нет
+        lines = _wrap(text, font, max_w)
 
+    hpx = _line_height(font)
     y = y0
-    for ln in lines:
-        wpx, hpx = draw.textsize(ln, font=font)
+    for ln, wpx in lines:
         if align == "left":
             x = x0
         elif align == "right":
@@ -93,56 +143,110 @@ def _text_block(
         y += int(hpx * line_height)
 
 
-def _project_dir(p: Any) -> Path:
+@functools.lru_cache(maxsize=128)
+def _build_qr(url: str, size: int) -> Image.Image:
+    """
+    Готовый RGB-тайл QR. Кэш по (url, size): смена qr_pos не кодирует QR заново.
+    Результат общий для всех рендеров — только вставлять через paste, не менять.
+    """
+    qr = qrcode.QRCode(border=1, box_size=10)
+    qr.add_data(url)
+    qr.make(fit=True)
+    # модули бинарные: растим сетку целым шагом и добиваем белым до size,
+    # без ресэмплинга — края модулей остаются чёткими
+    matrix = np.array(qr.get_matrix(), dtype=np.uint8)
+    n = matrix.shape[0]
+    px_per_mod = size // n
+    tile = (1 - matrix) * 255
+    if px_per_mod < 1 or size - n * px_per_mod > size // 10:
+        # модулей больше, чем пикселей, или целый шаг съедает заметную часть тайла:
+        # растягиваем сетку 1:1 через NEAREST — QR целиком и во весь size, без обрезки
+        return Image.fromarray(tile).resize((size, size), Image.Resampling.NEAREST).convert("RGB")
+    tile = np.kron(tile, np.ones((px_per_mod, px_per_mod), np.uint8))
+    pad = size - tile.shape[0]
+    tile = np.pad(tile, ((pad // 2, pad - pad // 2),) * 2, constant_values=255)
+    return Image.fromarray(np.stack([tile] * 3, axis=-1))
+
+
+def warm_caches(font_name: str = DEFAULT_FONT) -> None:
+    """
+    Прогрев кэша шрифтов процесса-рендерера (initializer пула): FreeType
+    разбирает TTF один раз на воркер, а не на первом рендере пользователя.
+    """
+    for size in FONT_SIZES:
+        _get_font(font_name, size)
+
+
+def _scaled_fresh(scaled: Path, src: Path) -> bool:
+    try:
+        return scaled.stat().st_mtime_ns >= src.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def _load_background(bg_path: Path, final: bool) -> Image.Image:
+    """
+    Фон размером с полотно. Готовый bg_scaled.jpg берём всегда; если его нет,
+    финал собирает и сохраняет его (LANCZOS), а превью — быстрый BILINEAR без записи.
+    """
+    if final or _scaled_fresh(bg_path.with_name("bg_scaled.jpg"), bg_path):
+        return Image.open(prepare_background(bg_path)).convert("RGB")
+    return Image.open(bg_path).convert("RGB").resize(CANVAS, Image.Resampling.BILINEAR)
+
+
+def prepare_background(bg_path: Path) -> Path:
     """
-    Каталог проекта на диске: DATA_DIR/<tg_id>/<project_id>
-    Требуются атрибуты p.user_id и p.id
+    Фон, один раз приведённый к размеру полотна: bg_scaled.jpg рядом с исходником.
+    Пересобирается, только если исходник новее — тогда LANCZOS не гоняется на каждый рендер.
     """
-    base = cfg.DATA_DIR / str(getattr(p, "user_id", "unknown")) / str(getattr(p, "id", "unknown"))
-    base.mkdir(parents=True, exist_ok=True)
-    return base
+    scaled = bg_path.with_name("bg_scaled.jpg")
+    if _scaled_fresh(scaled, bg_path):
+        return scaled
+    bg = Image.open(bg_path).convert("RGB").resize(CANVAS, Image.Resampling.LANCZOS)
+    # превью и финал могут собирать фон одновременно — подменяем файл целиком
+    tmp = scaled.with_suffix(".jpg.tmp")
+    bg.save(tmp, "JPEG", quality=92, subsampling=1)
+    os.replace(tmp, scaled)
+    return scaled
 
 
-def render_image(p: Any, *, final: bool = False) -> Path:
+def render_bytes(p: Dict[str, Any], *, final: bool = False) -> bytes:
     """
-    Сборка изображения (превью или финал) по параметрам проекта `p`.
-    Ожидаемые атрибуты у `p` (если чего-то нет — применим дефолты):
+    Сборка изображения (превью или финал) по параметрам проекта `p`, готовый JPEG в памяти.
+    Ожидаемые ключи в dict `p` (если чего-то нет — применим дефолты):
       - template: str (не используется напрямую, на будущее)
       - bg_mode: 'color'|'image', bg_color: '#rrggbb', bg_image: str|None
       - title, subtitle, body: str
       - font_name: путь к ttf|ttc, font_color: '#rrggbb', align: 'left'|'center'|'right'
       - qr_enabled: bool, qr_url: str, qr_pos: 'tl'|'tr'|'bl'|'br'|'c', qr_size: int
-      - id: str, user_id: int  (для путей)
     """
     W, H = CANVAS
-    bg_color = _hex_to_rgb(getattr(p, "bg_color", "#ffffff"))
+    bg_color = _hex_to_rgb(p.get("bg_color", "#ffffff"))
     img = Image.new("RGB", CANVAS, color=bg_color)
     draw = ImageDraw.Draw(img)
 
     # Фон-картинка
-    bg_mode = getattr(p, "bg_mode", "color")
-    bg_image = getattr(p, "bg_image", None)
+    bg_mode = p.get("bg_mode", "color")
+    bg_image = p.get("bg_image")
     if bg_mode == "image" and bg_image:
         try:
             bg_path = Path(str(bg_image))
             if bg_path.exists():
-                bg = Image.open(bg_path).convert("RGB").resize(CANVAS, Image.LANCZOS)
+                bg = _load_background(bg_path, final)
                 img.paste(bg, (0, 0))
         except Exception as e:
             log.warning("Не удалось применить фоновое изображение: %s", e)
 
     # Тексты
-    font_name = getattr(p, "font_name", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
-    color = _hex_to_rgb(getattr(p, "font_color", "#111111"))
-    align = getattr(p, "align", "center")
+    font_name = p.get("font_name", DEFAULT_FONT)
+    color = _hex_to_rgb(p.get("font_color", "#111111"))
+    align = p.get("align", "center")
 
-    title = getattr(p, "title", "")
-    subtitle = getattr(p, "subtitle", "")
-    body = getattr(p, "body", "")
+    title = p.get("title", "")
+    subtitle = p.get("subtitle", "")
+    body = p.get("body", "")
 
-    title_font = _get_font(font_name, 90)
-    subtitle_font = _get_font(font_name, 56)
-    body_font = _get_font(font_name, 44)
+    title_font, subtitle_font, body_font = (_get_font(font_name, sz) for sz in FONT_SIZES)
 
     # Области
     top_area = (MARGIN, MARGIN, W - MARGIN, H // 2)
@@ -154,16 +258,12 @@ def render_image(p: Any, *, final: bool = False) -> Path:
     _text_block(draw, body, body_area, body_font, color, align)
 
     # QR-код
-    if getattr(p, "qr_enabled", False) and getattr(p, "qr_url", ""):
+    if p.get("qr_enabled", False) and p.get("qr_url", ""):
         try:
-            size = max(120, min(600, int(getattr(p, "qr_size", 220))))
+            size = max(120, min(600, int(p.get("qr_size", 220))))
         except Exception:
             size = 220
-        qr = qrcode.QRCode(border=1, box_size=10)
-        qr.add_data(getattr(p, "qr_url"))
-        qr.make(fit=True)
-        qr_img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-        qr_img = qr_img.resize((size, size), Image.LANCZOS)
+        qr_img = _build_qr(str(p.get("qr_url")), size)
 
         positions = {
             "tl": (MARGIN, MARGIN),
@@ -172,15 +272,20 @@ def render_image(p: Any, *, final: bool = False) -> Path:
             "br": (W - MARGIN - size, H - MARGIN - size),
             "c": ((W - size) // 2, (H - size) // 2),
         }
-        pos_key = getattr(p, "qr_pos", "br")
+        pos_key = p.get("qr_pos", "br")
         img.paste(qr_img, positions.get(pos_key, positions["br"]))
 
-    # Сохранение
-    out_dir = _project_dir(p)
-    out = out_dir / ("final.jpg" if final else "preview.jpg")
-    try:
-        img.save(out, quality=90)
-    except Exception as e:
-        log.error("Не удалось сохранить изображение: %s", e)
-        raise
-    return out
+    # Кодирование
+    buf = io.BytesIO()
+    # превью Telegram всё равно пережмёт; финал оставляем архивного качества
+    img.save(buf, "JPEG", quality=92 if final else 85, subsampling=2, optimize=False, progressive=False)
+    return buf.getvalue()
+
+
+def write_render(out: Path, data: bytes) -> None:
+    # через tmp: читатель никогда не увидит недописанный jpg
+    tmp = out.with_suffix(".jpg.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, out)
+